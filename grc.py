@@ -18,19 +18,27 @@
 """ GGSIPU Results Crawler Script """
 __version__ = "0.2"
 
+import argparse
 import hashlib
-import json
+import multiprocessing
 import os
+import re
 import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from html import unescape
 from io import BytesIO
+from itertools import takewhile
 from logging import DEBUG, INFO, WARNING, Formatter, StreamHandler, getLogger, handlers
 from urllib.parse import urljoin
 
-import bs4 as bs
-import firebase_admin
-from firebase_admin import db as firebase_db
-from firebase_admin import storage as firebase_storage
-from requests import get
+import orjson
+from requests import Session
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util.retry import Retry
 
 from ggsipu_result import parse_result_pdf, toDict
 
@@ -42,44 +50,87 @@ if sys.version_info < (3, 8):
 # UTILITY FUNCTIONS
 
 
-def has_option(name):
-    try:
-        sys.argv.remove("--%s" % name)
-        return True
-    except ValueError:
-        pass
-    # allow passing all cmd line options also as environment variables
-    env_val = os.getenv(name.upper().replace("-", "_"), "false").lower()
-    if env_val == "true":
-        return True
-    return False
-
-
-def option_value(name):
-    for index, option in enumerate(sys.argv):
-        if option == "--" + name:
-            if index + 1 >= len(sys.argv):
-                raise Exception("The option %s requires a value" % option)
-            value = sys.argv[index + 1]
-            sys.argv[index : index + 2] = []
-            return value
-        if option.startswith("--" + name + "="):
-            value = option[len(name) + 3 :]
-            sys.argv[index : index + 1] = []
-            return value
-    env_val = os.getenv(name.upper().replace("-", "_"))
-    return env_val
-
-
-def tryint(i):
-    if i is None:
-        return None
-    try:
-        return int(i)
-    except ValueError:
-        return None
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def parse_options(argv):
+    # all cmd line options can also be passed as environment variables, cmd line
+    # takes precedence (`--results-url` or RESULTS_URL)
+    env = {k.lower().replace("_", "-"): v for k, v in os.environ.items()}
+    # no prefix matching of option names, unknown options are ignored as they are
+    parser = argparse.ArgumentParser(description=__doc__, allow_abbrev=False)
+
+    def flag(name, help):
+        parser.add_argument(
+            f"--{name}",
+            action="store_true",
+            default=env.get(name, "false").lower() == "true",
+            help=help,
+        )
+
+    def value(name, help, type=str):
+        parser.add_argument(f"--{name}", type=type, default=env.get(name), help=help)
+
+    flag("production", "running on server, log only to console")
+    value("log-path", "path to save logs")
+    value("log-level", "DEBUG, INFO or WARNING")
+    value("last-json", "last processed pdf info, as json data or a file path")
+    value("pdf-pattern", "process only pdfs with title matching the regex")
+    value("results-url", "results url to start from")
+    value("scrap-depth", "number of previous results pages to scrap", int)
+    flag("force-all", "process all the pdfs discarding last json")
+    flag("skip-images", "skip the image uploads")
+    flag("skip-data", "skip all json data uploads")
+    flag("exit-on-image-error", "stop if error in uploading images")
+    value("download-workers", "max number of pdfs downloaded together", positive_int)
+    value("parse-workers", "number of processes parsing pdfs", positive_int)
+    # unknown options are ignored
+    options, _ = parser.parse_known_args(argv)
+    return options
+
+
+def prefetch(func, iterable, workers, executor_class=ThreadPoolExecutor):
+    # Lazy map of func over iterable in a pool (threads by default), yields results
+    # in input order while keeping at most `workers` calls in flight (bounded memory).
+    with executor_class(max_workers=workers) as executor:
+        pending = deque()
+        for item in iterable:
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def create_session(headers):
+    # Single pooled session so that connections to the results server are kept
+    # alive and reused across the index pages and PDF downloads.
+    session = Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        # retry on connection errors and on transient gateway errors, if still
+        # failing then the last response is returned instead of raising
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
+# Results are keyed by the hash of their content, so processing a pdf again
+# (after a crash or with --force-all) rewrites the same database paths instead
+# of adding duplicate results.
 def generate_result_hash(result):
     return hashlib.md5(result.toJSON().encode("utf-8", errors="ignore")).hexdigest()
 
@@ -90,51 +141,91 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.3945.16 Safari/537.36"
 }
 
+# Timeout (in seconds) for every http request
+REQUEST_TIMEOUT = 30
+
+SESSION = create_session(HEADERS)
+
+OPTIONS = parse_options(sys.argv[1:])
+
 LOG_LEVEL_CONFIG = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING}
 ROOT = os.path.abspath(os.path.dirname(__file__))
-PRODUCTION = has_option("production")
+PRODUCTION = OPTIONS.production
 DEFAULT_LAST_JSON_FILE = os.path.join(ROOT, "last", "last.json")
 
 # Path to save logs
-LOG_PATH = option_value("log-path") or "grc.log"
+LOG_PATH = OPTIONS.log_path or "grc.log"
 
-# Log level - DEBUG, INFO, WARNING
-LOG_LEVEL = LOG_LEVEL_CONFIG.get(option_value("log-level")) or DEBUG
+# Log level - DEBUG, INFO, WARNING (default INFO on server, DEBUG on local)
+LOG_LEVEL = LOG_LEVEL_CONFIG.get(OPTIONS.log_level) or (
+    INFO if PRODUCTION else DEBUG
+)
 
 # Last processed pdf_info, if starts with '{' will be loaded as json data
 # else will be assumed a file containing json data.
-LAST_JSON = option_value("last-json") or DEFAULT_LAST_JSON_FILE
+LAST_JSON = OPTIONS.last_json or DEFAULT_LAST_JSON_FILE
+
+# Directory of LAST_JSON file, other state files are saved next to it
+LAST_DIR = os.path.dirname(
+    DEFAULT_LAST_JSON_FILE if LAST_JSON.startswith("{") else LAST_JSON
+)
+
+# Last crawled results index (pdfs, ETag and Last-Modified of RESULTS_URL), saved
+# so that unmodified index is not crawled again.
+LAST_INDEX_JSON = os.path.join(LAST_DIR, "last_index.json")
+
+# SHA-1 of urls of all processed pdfs (one per line), so that they are not
+# processed again if the saved last pdf is not found in index anymore.
+PROCESSED_SET = os.path.join(LAST_DIR, "processed.set")
 
 # filter the pdf based on regex pattern
-PDF_FILTER_PATTERN = option_value("pdf-pattern")
+PDF_FILTER_PATTERN = OPTIONS.pdf_pattern
 
 # Results url to start from
 RESULTS_URL = (
-    option_value("results-url")
-    or "http://164.100.158.135/ExamResults/ExamResultsmain.htm"
+    OPTIONS.results_url or "http://164.100.158.135/ExamResults/ExamResultsmain.htm"
 )
 
 # Results scraping depth
-RESULT_SCRAP_DEPTH = (
-    2 if (depth := tryint(option_value("scrap-depth"))) is None else depth
-)
+RESULT_SCRAP_DEPTH = 2 if OPTIONS.scrap_depth is None else OPTIONS.scrap_depth
 
 # Will process all the PDFs discarding LAST_JSON
-OPTION_FORCE_ALL = has_option("force-all")
+OPTION_FORCE_ALL = OPTIONS.force_all
 
 # NOTE: set the both true for dry runs
 # Skip the image uploads
-OPTION_SKIP_UPLOAD_IMAGES = has_option("skip-images")
+OPTION_SKIP_UPLOAD_IMAGES = OPTIONS.skip_images
 # Skip all json data uploads
-OPTION_SKIP_UPLOAD_DATA = has_option("skip-data")
+OPTION_SKIP_UPLOAD_DATA = OPTIONS.skip_data
 
 # Script will stop if error in uploading images
-OPTION_EXIT_ON_IMAGE_ERROR = has_option("exit-on-image-error")
+OPTION_EXIT_ON_IMAGE_ERROR = OPTIONS.exit_on_image_error
+
+# Max number of PDFs downloaded concurrently (ahead of processing)
+DOWNLOAD_WORKERS = OPTIONS.download_workers or 8
+
+# Number of processes parsing PDFs in parallel (ahead of dumping), parsing is
+# memory heavy so by default at most 4 even on bigger machines
+PARSE_WORKERS = OPTIONS.parse_workers or min(os.cpu_count() or 1, 4)
+
+# Parse processes are started by a fork server (where available) and not forked
+# from this process, forking while download threads hold locks may deadlock them
+PARSE_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+)
+
+# Max number of student images uploaded concurrently
+IMAGE_UPLOAD_WORKERS = 8
 
 
 def setupLogging(logfile, to_file=True):
     logger = getLogger()
-    logger.setLevel(DEBUG)
+    # handlers are added only once, else every record is logged multiple times
+    if logger.handlers:
+        return logger
+    # same as handlers level, so that logger.isEnabledFor() can skip building
+    # large debug messages when they would be discarded anyway
+    logger.setLevel(LOG_LEVEL)
 
     if to_file:
         # Set up logging to the logfile.
@@ -159,44 +250,41 @@ def setupLogging(logfile, to_file=True):
     return logger
 
 
-def _only_result_tr(tag):
-    return (
-        tag.name == "tr" and tag.parent.name == "tbody" and tag.td and not tag.td.strong
-    )
-
-
-def _previous_result_td(tag):
-    return (
-        tag.name == "td"
-        and tag.parent.name == "tr"
-        and tag.attrs.get("class")
-        and "auto-style1" in tag.attrs.get("class")
-    )
+# Runs of whitespace (including newlines) in scraped text
+_WS_RE = re.compile(r"\s+")
+# 'previous results' link of an index page, found without building the DOM
+# (auto-style1 as a whole class, not a prefix of auto-style10 etc.)
+_NEXT_RE = re.compile(
+    r'<td\s[^>]*\bclass="(?:[^"]*\s)?auto-style1(?:\s[^"]*)?"[^>]*>\s*'
+    r'<a\s[^>]*\bhref="([^"]+)"',
+    re.IGNORECASE,
+)
 
 
 def scrap_result_tr(tr, base_url):
-    tds = tr.find_all("td")
-    # Check if only two tds are present
-    if len(tds) != 2:
+    # direct td children, cheaper than a css query (compiled per call) for each row
+    tds = [node for node in tr.iter() if node.tag == "td"]
+    # Check if only two tds are present and it is not a heading row
+    if len(tds) != 2 or tds[0].css_first("strong"):
         return None
 
     # Gets the result title and download link
-    notice_a = tds[0].a
+    notice_a = tds[0].css_first("a")
     if notice_a:
-        notice_txt = notice_a.text
-        dwd_url = notice_a.get("href", None)
+        notice_txt = notice_a.text()
+        dwd_url = notice_a.attributes.get("href", None)
         if not dwd_url or not notice_txt:
             return None
 
-        notice_date = tds[1].text
+        notice_date = tds[1].text()
         if not notice_date:
             return None
 
         # Remove newlines, extra whitespaces
-        title = " ".join(notice_txt.split())
+        title = _WS_RE.sub(" ", notice_txt).strip()
 
         return {
-            "date": notice_date.strip(),
+            "date": _WS_RE.sub(" ", notice_date).strip(),
             "title": title,
             "url": urljoin(base_url, dwd_url.strip()),
         }
@@ -204,8 +292,8 @@ def scrap_result_tr(tr, base_url):
         return None
 
 
-def scrap_results_pdfs(soup, base_url):
-    trs = soup.find_all(_only_result_tr)
+def scrap_results_pdfs(tree, base_url):
+    trs = tree.css("tbody > tr")
     # Discarding
     for tr in trs:
         result_pdf = scrap_result_tr(tr, base_url)
@@ -213,40 +301,103 @@ def scrap_results_pdfs(soup, base_url):
             yield result_pdf
 
 
-def get_result_pdfs(url=RESULTS_URL, recursive=0):
-    logger.debug(f"Scraping pdf from {url} with recursive={recursive}")
-    html = get(url, headers=HEADERS).text
-    soup = bs.BeautifulSoup(html, "lxml")
-
-    pdfs = list(scrap_results_pdfs(soup, url))
-    if recursive > 0:
-        next_td = soup.find(_previous_result_td)
-        next_href = None
-        if (
-            (next_td := soup.find(_previous_result_td))
-            and (next_td.a)
-            and (next_href := next_td.a.attrs.get("href"))
-        ):
-            next_url = urljoin(url, next_href)
-            pdfs += get_result_pdfs(next_url, recursive - 1)
+def fetch_html(url):
+    return SESSION.get(url, timeout=REQUEST_TIMEOUT).text
+
+
+def get_result_pdfs(url=RESULTS_URL, recursive=0, html=None):
+    pdfs = []
+    # pages already scraped, guards against 'previous' links forming a cycle
+    seen = set()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            logger.debug("Scraping pdf from %s with recursive=%s", url, recursive)
+            seen.add(url)
+            if html is None:
+                html = fetch_html(url)
+            tree = None
+
+            next_page = None
+            if recursive > 0:
+                if match := _NEXT_RE.search(html):
+                    next_href = unescape(match.group(1))
+                else:
+                    # markup changed, fall back to the DOM lookup
+                    tree = LexborHTMLParser(html)
+                    next_a = tree.css_first("tr > td.auto-style1 a")
+                    next_href = next_a.attributes.get("href") if next_a else None
+                if next_href:
+                    next_url = urljoin(url, next_href)
+                    if next_url not in seen:
+                        # fetch the next page in background while this one is scraped
+                        next_page = executor.submit(fetch_html, next_url)
+
+            if tree is None:
+                tree = LexborHTMLParser(html)
+            pdfs.extend(scrap_results_pdfs(tree, url))
+            if next_page is None:
+                break
+            url, html, recursive = next_url, next_page.result(), recursive - 1
+    return pdfs
+
+
+def crawl_result_pdfs(url=RESULTS_URL, recursive=0):
+    # Conditional request for the index page, if it is not modified since last
+    # crawl then the saved pdfs are reused instead of scraping all pages again.
+    index = load_last_index()
+    headers = {}
+    if index and (index["url"], index["recursive"]) == (url, recursive):
+        if etag := index.get("etag"):
+            headers["If-None-Match"] = etag
+        if last_modified := index.get("last_modified"):
+            headers["If-Modified-Since"] = last_modified
+
+    resp = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if resp.status_code == 304:
+        logger.debug("Results index not modified since last crawl - %s", headers)
+        return index["pdfs"]
+
+    pdfs = get_result_pdfs(url, recursive, html=resp.text)
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if resp.status_code == 200 and (etag or last_modified):
+        dump_last_index(
+            {
+                "url": url,
+                "recursive": recursive,
+                "etag": etag,
+                "last_modified": last_modified,
+                "pdfs": pdfs,
+            }
+        )
     return pdfs
 
 
-def download_file(url, html_allow=False, headers=HEADERS, raise_ex=False):
+def stream_file(url, fp, headers=None, raise_ex=False, chunk_size=64 * 1024):
+    # Streams the response body into file object `fp` chunk by chunk, whole body
+    # is never held in memory. Returns whether the download succeeded.
     try:
-        resp = get(url, headers=headers)
-        if (
-            not resp.status_code == 200
-            or resp.content is None
-            or (("text/html" in resp.headers["Content-Type"]) & (html_allow is False))
-        ):
-            raise Exception()
-        ret = resp.text if html_allow else resp.content
-        return ret
+        with SESSION.get(
+            url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT
+        ) as resp:
+            # status and headers are checked before the body is downloaded
+            if not resp.ok or "text/html" in resp.headers.get("Content-Type", ""):
+                raise Exception()
+            for chunk in resp.iter_content(chunk_size):
+                fp.write(chunk)
+            return True
     except Exception as ex:
         if raise_ex:
             raise ex
-        return None
+        return False
+
+
+def _encode_jpeg(image):
+    # Pillow releases the GIL while encoding, so this runs in parallel on the
+    # image upload threads.
+    img_fp = BytesIO()
+    image.save(img_fp, format="JPEG")
+    return img_fp.getvalue()
 
 
 class BaseDump:
@@ -259,11 +410,20 @@ class BaseDump:
         return self
 
     def start(self):
+        # Returns the future of commit() (if any) for data still being written
+        future = None
         if not OPTION_SKIP_UPLOAD_DATA:
             self.dump_results()
             self.dump_subjects()
+            future = self.commit()
         if not OPTION_SKIP_UPLOAD_IMAGES:
             self.dump_images()
+        return future
+
+    def commit(self):
+        # For dumps which batch the data of dump_results and dump_subjects, may
+        # return a future if data is written in background
+        return None
 
     def dump_results(self):
         raise NotImplementedError
@@ -298,189 +458,371 @@ class FirebaseDump(BaseDump):
         blob.content_type = "image/jpeg"
         # try:
         if not blob.exists():
-            logger.debug(f"Uploading Student image - {blob.name}")
-            img_fp = BytesIO()
-            result.image.save(img_fp, format="JPEG")
-            blob.upload_from_file(img_fp, rewind=True)
+            logger.debug("Uploading Student image - %s", blob.name)
+            # upload the original JPEG stream of pdf (/DCTDecode) as it is when
+            # ggsipu_result provides it, re-encoding is only needed otherwise
+            image_bytes = getattr(result, "image_bytes", None) or _encode_jpeg(
+                result.image
+            )
+            blob.upload_from_string(image_bytes, content_type="image/jpeg")
         else:
-            logger.debug(f"Skipping Student image, already present at {blob.name}")
+            logger.debug("Skipping Student image, already present at %s", blob.name)
         # except Exception as ex:
         #     logger.exception(str(ex))
 
-    def _process_institutions(self, results):
+    def _process_results(self, results, pdf_info):
+        # Institutions, student details and results are built in one pass. Keep
+        # them as flat leaf paths, update() replaces the whole node for any nested
+        # dict value (other results of student included).
         inst_dict = {}
+        stu_dict = {}
+        res_dict = {}
         for r in results:
-            if self._check_result(r) and r.institution_name:
-                inst_dict[r.institution_code] = r.institution_name
-            else:
+            if not self._check_result(r):
                 logger.warning(
-                    f"Not processing Institution as Insufficient data in {toDict(r)}"
+                    f"Not processing Institution, Student and Result as Insufficient "
+                    f"info in {toDict(r)}"
                 )
-        if len(inst_dict) > 0:
-            inst_ref = self.ref.child("institutions")
-            logger.debug(f"UPDATE Institutions {inst_dict}")
-            inst_ref.update(inst_dict)
+                continue
 
-    def _process_students(self, results):
-        update_dict = {}
-        for r in results:
-            if self._check_result(r):
-                base_key = f"{r.institution_code}/{r.batch}/{r.roll_num}"
-
-                update_dict[f"{base_key}/name"] = r.student_name
-                update_dict[f"{base_key}/programme_code"] = r.programme_code
-                update_dict[f"{base_key}/programme_name"] = r.programme_name
-                update_dict[f"{base_key}/batch"] = r.batch
+            if r.institution_name:
+                # skip institutions already seen in this pdf or written in this run
+                if self._inst_cache.get(r.institution_code) != r.institution_name:
+                    self._inst_cache[r.institution_code] = r.institution_name
+                    inst_dict[f"institutions/{r.institution_code}"] = r.institution_name
             else:
-                logger.warn(f"Not processing Student as Insufficient info in {r}")
-        if len(update_dict) > 0:
-            stu_ref = self.ref.child("students")
-            logger.debug(f"UPDATE Students {update_dict}")
-            stu_ref.update(update_dict)
-
-    def _process_results(self, results, pdf_info):
-        res_dict = {}
-        for r in results:
-            if self._check_result(r):
-                base_ref_addr = f"{r.institution_code}/{r.batch}/{r.roll_num}/results"
-                unique_key = generate_result_hash(r)
-                res_dict[f"{base_ref_addr}/{unique_key}"] = self._generate_result_dict(
-                    r, pdf_info
+                logger.warning(
+                    f"Not processing Institution as Insufficient data in {toDict(r)}"
                 )
-            else:
-                logger.warn(f"Not processing Result as Insufficient info in {r}")
-        if len(res_dict) > 0:
-            stu_ref = self.ref.child("students")
-            logger.debug(f"UPDATE Results {res_dict}")
-            stu_ref.update(res_dict)
+
+            base_key = f"students/{r.institution_code}/{r.batch}/{r.roll_num}"
+
+            unique_key = getattr(r, "result_hash", None) or generate_result_hash(r)
+            res_dict[f"{base_key}/results/{unique_key}"] = self._generate_result_dict(
+                r, pdf_info
+            )
+
+            # skip students whose details are already written in this run
+            student_key = (r.institution_code, r.batch, r.roll_num)
+            student_info = (r.student_name, r.programme_code, r.programme_name)
+            if self._student_cache.get(student_key) == student_info:
+                continue
+            self._student_cache[student_key] = student_info
+
+            stu_dict[f"{base_key}/name"] = r.student_name
+            stu_dict[f"{base_key}/programme_code"] = r.programme_code
+            stu_dict[f"{base_key}/programme_name"] = r.programme_name
+            stu_dict[f"{base_key}/batch"] = r.batch
+        if logger.isEnabledFor(DEBUG):
+            if len(inst_dict) > 0:
+                logger.debug("UPDATE Institutions %s", inst_dict)
+            if len(stu_dict) > 0:
+                logger.debug("UPDATE Students %s", stu_dict)
+            if len(res_dict) > 0:
+                logger.debug("UPDATE Results %s", res_dict)
+        return {**inst_dict, **stu_dict, **res_dict}
 
     def init(self):
-        self.app = firebase_admin.initialize_app()
-        self.db = firebase_db
-        self.ref = firebase_db.reference("server/data")
-        self.bucket = firebase_storage.bucket()
+        # firebase app is initialized on first dump, most runs have nothing to dump
+        self.app = None
         # image upload errors
         self.img_upload_error = False
+        # institutions and students details already written in this run
+        self._inst_cache = {}
+        self._student_cache = {}
+        # pending multi-path update, see commit()
+        self._update_dict = {}
+        # single thread, so that updates are written in the order of pdfs
+        self._commit_executor = ThreadPoolExecutor(max_workers=1)
+        self._last_commit = None
         return self
 
+    def _ensure_init(self):
+        if self.app is None:
+            # imported here, firebase_admin is slow to import and not needed
+            # when there are no new pdfs
+            import firebase_admin
+            from firebase_admin import db as firebase_db
+            from firebase_admin import storage as firebase_storage
+
+            self.app = firebase_admin.initialize_app()
+            self.db = firebase_db
+            self.ref = firebase_db.reference("server/data")
+            self.bucket = firebase_storage.bucket()
+
+    def start(self):
+        self._ensure_init()
+        return super().start()
+
+    def commit(self):
+        # Write everything in a single multi-path update, so whole pdf is
+        # written atomically in one request. It is sent in background so that
+        # images and next pdfs are processed meanwhile.
+        update_dict, self._update_dict = self._update_dict, {}
+        if len(update_dict) > 0:
+            self._last_commit = self._commit_executor.submit(
+                self._update, update_dict, self._last_commit
+            )
+            return self._last_commit
+        return None
+
+    def _update(self, update_dict, previous):
+        # pdfs are written in order, so nothing is written after an earlier
+        # write failed (previous is already done, single commit thread)
+        if previous is not None:
+            previous.result()
+        self.ref.update(update_dict)
+
     # DUMPING METHODS
     def dump_results(self):
-        self._process_institutions(self.results)
-        self._process_students(self.results)
-        self._process_results(self.results, self.pdf_info)
+        self._update_dict.update(self._process_results(self.results, self.pdf_info))
 
     def dump_subjects(self):
-        subs_ref = self.ref.child("subjects")
         if len(self.subs) > 0:
-            logger.debug(f"UPDATE Subjects {toDict(self.subs)}")
-            subs_ref.update(toDict(self.subs))
+            subs_dict = toDict(self.subs)
+            if logger.isEnabledFor(DEBUG):
+                logger.debug("UPDATE Subjects %s", subs_dict)
+            self._update_dict.update({f"subjects/{k}": v for k, v in subs_dict.items()})
 
     def dump_images(self):
         if not self.img_upload_error:
+            results = []
             for r in self.results:
                 if self._check_result(r) and r.image:
-                    try:
-                        self._upload_student_image(r)
-                    except Exception as ex:
-                        if OPTION_EXIT_ON_IMAGE_ERROR:
-                            raise ex
-                        else:
-                            logger.exception(ex)
-
-                        logger.warning(
-                            f"Probably GCloud limit reached, Stoping image uploads  at PDF-{self.pdf_info}"
-                        )
-                        logger.warning(
-                            "To resume image uploads, rerun script with LAST_JSON and SKIP_UPLOAD_DATA options to upload images only"
-                        )
-                        # break from for loop
-                        self.img_upload_error = True
-                        break
+                    results.append(r)
                 else:
                     logger.warning(
                         f"Not processing Student Image as Insufficient data in {toDict(r)}"
                     )
 
+            with ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_WORKERS) as executor:
+                try:
+                    # map() cancels the pending uploads as soon as one fails
+                    list(executor.map(self._upload_student_image, results))
+                except Exception as ex:
+                    if OPTION_EXIT_ON_IMAGE_ERROR:
+                        raise ex
+                    else:
+                        logger.exception(ex)
+
+                    logger.warning(
+                        f"Probably GCloud limit reached, Stoping image uploads  at PDF-{self.pdf_info}"
+                    )
+                    logger.warning(
+                        "To resume image uploads, rerun script with LAST_JSON and SKIP_UPLOAD_DATA options to upload images only"
+                    )
+                    self.img_upload_error = True
+
 
 def dump_last(pdfinfo):
     json_file = LAST_JSON
     if json_file.startswith("{"):
         json_file = DEFAULT_LAST_JSON_FILE
     os.makedirs(os.path.dirname(json_file), exist_ok=True)
-    with open(json_file, "w") as fp:
-        json.dump(pdfinfo, fp)
-        logger.debug(f"Last PDF info saved - {pdfinfo}")
+    with open(json_file, "wb") as fp:
+        fp.write(orjson.dumps(pdfinfo))
+        logger.debug("Last PDF info saved - %s", pdfinfo)
 
 
 def load_last():
     last = None
     try:
         if LAST_JSON.startswith("{"):
-            last = json.loads(LAST_JSON)
+            last = orjson.loads(LAST_JSON)
         elif os.path.isfile(LAST_JSON):
-            with open(LAST_JSON, "r") as fp:
-                last = json.load(fp)
-    except json.decoder.JSONDecodeError as ex:
+            with open(LAST_JSON, "rb") as fp:
+                last = orjson.loads(fp.read())
+    except orjson.JSONDecodeError as ex:
         logger.exception(str(ex))
 
     if last:
-        logger.debug(f"Last PDF info loaded - {last}")
+        logger.debug("Last PDF info loaded - %s", last)
     else:
         logger.debug("No Last PDF loaded")
     return last
 
 
+def dump_last_index(index):
+    os.makedirs(os.path.dirname(LAST_INDEX_JSON), exist_ok=True)
+    with open(LAST_INDEX_JSON, "wb") as fp:
+        fp.write(orjson.dumps(index))
+        logger.debug("Last results index saved - %s", LAST_INDEX_JSON)
+
+
+def load_last_index():
+    try:
+        with open(LAST_INDEX_JSON, "rb") as fp:
+            return orjson.loads(fp.read())
+    except FileNotFoundError:
+        pass
+    except orjson.JSONDecodeError as ex:
+        logger.exception(str(ex))
+    return None
+
+
+def pdf_hash(pdf_info):
+    return hashlib.sha1(pdf_info["url"].encode()).hexdigest()
+
+
+def dump_processed(pdf_info):
+    os.makedirs(LAST_DIR, exist_ok=True)
+    with open(PROCESSED_SET, "a") as fp:
+        fp.write(pdf_hash(pdf_info) + "\n")
+
+
+def load_processed():
+    try:
+        with open(PROCESSED_SET, "r") as fp:
+            return set(fp.read().split())
+    except FileNotFoundError:
+        return set()
+
+
+def pdf_key(pdf_info):
+    # date is normalized, last saved before whitespace in scraped dates was
+    # collapsed still matches its pdf
+    return (pdf_info["url"], _WS_RE.sub(" ", pdf_info["date"]).strip())
+
+
 def new_result_pdfs():
     last = load_last()
-    all_pdfs = get_result_pdfs(recursive=RESULT_SCRAP_DEPTH)
+    all_pdfs = crawl_result_pdfs(recursive=RESULT_SCRAP_DEPTH)
     # filter the PDfs
     if PDF_FILTER_PATTERN:
         all_pdfs = list(filter_pdfs(all_pdfs))
 
-    if not last or OPTION_FORCE_ALL:
+    if OPTION_FORCE_ALL:
         return all_pdfs
-    else:
-        pdfs = []
-        for pdf in all_pdfs:
-            if pdf != last:
-                pdfs.append(pdf)
-            else:
-                break
-        return pdfs
 
+    if last:
+        # pdfs are listed newest first, take them until the last processed one
+        last_key = pdf_key(last)
+        new_pdfs = list(takewhile(lambda pdf: pdf_key(pdf) != last_key, all_pdfs))
+        # all of them are processed even if done before, e.g. rerun with an
+        # older LAST_JSON to upload the failed images only
+        if len(new_pdfs) < len(all_pdfs):
+            return new_pdfs
+    # last is not found if site has changed it (title, date etc.), skip already
+    # processed pdfs
+    processed = load_processed()
+    return [pdf for pdf in all_pdfs if pdf_hash(pdf) not in processed]
 
-def filter_pdfs(pdf_infos):
-    import re
 
+def filter_pdfs(pdf_infos):
     RE_PDF = re.compile(PDF_FILTER_PATTERN)
     for pdf_info in pdf_infos:
         if _ := RE_PDF.search(pdf_info["title"]):
             yield pdf_info
 
 
-def main(dumps):
+def is_pdf(pdf_info):
+    return pdf_info["url"].split(".")[-1].lower() in ("pdf",)
+
+
+def download_pdf(pdf_info, download_dir):
+    # Non PDF documents are not downloaded, main() skips them. PDFs are saved in
+    # download_dir so that parser processes are passed a path, not the pdf data.
+    if is_pdf(pdf_info):
+        fd, path = tempfile.mkstemp(suffix=".pdf", dir=download_dir)
+        with os.fdopen(fd, "wb") as fp:
+            downloaded = stream_file(pdf_info["url"], fp)
+        if downloaded:
+            return path
+        os.remove(path)
+    return None
+
+
+def parse_pdf(path):
+    # Runs in worker process, failed or skipped downloads have nothing to parse
+    if path is None:
+        return None
     try:
-        pdf_infos = new_result_pdfs()
-        logger.info(f"{len(pdf_infos)} - New Result PDFs found")
-        for i, pdf_info in enumerate(reversed(pdf_infos)):
+        parsed = parse_result_pdf(path)
+    finally:
+        os.remove(path)
+    if parsed:
+        # result keys are hashed before results are pickled back to the main
+        # process, unpickled images differ (PIL _readonly) and so their json
+        for result in parsed[1]:
+            result.result_hash = generate_result_hash(result)
+    return parsed
+
+
+def wait_and_dump_last(pdf_info, futures):
+    # last is saved only after all the data of pdf is written successfully
+    for future in futures:
+        if future is not None:
+            future.result()
+    dump_last(pdf_info)
+    dump_processed(pdf_info)
+
+
+def is_written(futures):
+    # waits for the data of pdf, True if all of it is written without error
+    return all(future is None or future.exception() is None for future in futures)
+
+
+def dump_pdfs(dumps, pdf_infos, parsed_pdfs):
+    # pdf_info and commit futures of the previous pdf, its data is written while
+    # the next pdf is dumped
+    pending = None
+    try:
+        for i, (pdf_info, parsed) in enumerate(zip(pdf_infos, parsed_pdfs)):
             # Check if file is PDF or not
-            if pdf_info["url"].split(".")[-1].lower() in ("pdf",):
+            if is_pdf(pdf_info):
                 logger.info(f"Processing pdf {i+1}/{len(pdf_infos)} - {pdf_info}")
-                if pdf := download_file(pdf_info["url"]):
-                    subs, results = parse_result_pdf(BytesIO(pdf))
+                if parsed:
+                    subs, results = parsed
                     logger.info(
                         f'{len(subs)} Subjects, {len(results)} Results found in {pdf_info["url"]}'
                     )
+                    futures = []
                     for dump in dumps:
-                        logger.debug(f"Dumping into {dump}")
-                        dump.set_data(pdf_info, results, subs).start()
+                        logger.debug("Dumping into %s", dump)
+                        futures.append(dump.set_data(pdf_info, results, subs).start())
 
                     # FIXME:  better logic to save last, refer inu.py
-                    dump_last(pdf_info)
+                    if pending:
+                        wait_and_dump_last(*pending)
+                    pending = (pdf_info, futures)
             else:
                 logger.warning(
                     f"Not Processing as file is not a PDF document - {pdf_info}"
                 )
+        if pending:
+            wait_and_dump_last(*pending)
+            pending = None
+    finally:
+        # a later pdf failed (parse, images or its write) after the data of
+        # previous pdf is written, save last for it so it is not written again
+        if pending and is_written(pending[1]):
+            wait_and_dump_last(*pending)
+
+
+def main(dumps, pdf_infos):
+    try:
+        # process oldest first, so that last always points to a processed pdf
+        pdf_infos.reverse()
+        with tempfile.TemporaryDirectory(prefix="grc-") as download_dir:
+            # pipeline - next PDFs are downloaded (threads) and parsed (processes)
+            # in background while current one is dumped, in order, on main thread.
+            pdfs = prefetch(
+                partial(download_pdf, download_dir=download_dir),
+                pdf_infos,
+                DOWNLOAD_WORKERS,
+            )
+            parsed_pdfs = prefetch(
+                parse_pdf,
+                pdfs,
+                PARSE_WORKERS,
+                partial(ProcessPoolExecutor, mp_context=PARSE_MP_CONTEXT),
+            )
+            try:
+                dump_pdfs(dumps, pdf_infos, parsed_pdfs)
+            finally:
+                # wait for background work before download_dir is removed
+                parsed_pdfs.close()
+                pdfs.close()
 
     except Exception as ex:
         logger.exception(str(ex))
@@ -494,9 +836,18 @@ if __name__ == "__main__":
         logger = setupLogging(LOG_PATH, True)
         logger.info(f"SCRIPT STARTED (v{__version__}) [LOCAL]")
 
-    dumps = [
-        FirebaseDump().init(),
-    ]
-    logger.info(f"Crawler Dumps - {dumps}")
-    main(dumps)
+    try:
+        pdf_infos = new_result_pdfs()
+    except Exception as ex:
+        logger.exception(str(ex))
+        pdf_infos = []
+    logger.info(f"{len(pdf_infos)} - New Result PDFs found")
+
+    # dumps are only set up when there is something to dump
+    if pdf_infos:
+        dumps = [
+            FirebaseDump().init(),
+        ]
+        logger.info(f"Crawler Dumps - {dumps}")
+        main(dumps, pdf_infos)
     logger.info(f"SCRIPT ENDED (v{__version__}) {os.linesep}")